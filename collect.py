@@ -5,172 +5,406 @@ Collection script for scooter data.
 
 """
 
+import aiohttp
 import asyncio
-import json
-import requests
+import gc
+import gzip
+import hashlib
+import heapq
+import orjson
+import os
+import re
+import sys
+import time
 
 from loguru import logger
-from dataclasses import dataclass
-from datetime import datetime
+from collections import defaultdict
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, DefaultDict, Dict, List, Sequence, Tuple
 
 
-@dataclass
+@dataclass(frozen=True)
 class StreamParams:
     name: str
     url: str
-    cooldown: int
+    cooldown: int = 15  # for providers that don't say how often they refresh
+
+
+@dataclass
+class StreamState:
+    last_updated: int = 0  # after a request is made, will be unixtime
+    last_hash: bytes = b""  # digest of the last queued payload, minus its timestamp
+    validators: Dict[str, str] = field(default_factory=dict)  # conditional GET headers
+
+
+# The trial period ends at 10 PM nightly; see `trial_over`
+END_HOUR = 22
+next_end_check = 0.0  # Unix time after which we look at the clock again
+is_trial_over = False
+
+# Top-level GBFS timestamp key, and VeoRide's off-spec spelling of it
+LAST_UPDATED = "last_updated"
+LAST_UPDATED_CAMEL = "lastUpdated"
+# Either spelling, matched in the raw bytes of a response. The trailing delimiter makes
+# sure we never read a number that's been cut off by the end of the search window.
+LAST_UPDATED_PATTERN = re.compile(
+    rb'"last(?:_u|U)pdated"\s*:\s*(\d+(?:\.\d+)?)\s*[,}]'
+)
+
+# Snapshots waiting to be written, keyed by stream name; see `flusher`
+pending: DefaultDict[str, List[Dict[Any, Any]]] = defaultdict(list)
+
+# What we know about each stream, keyed by stream name. This lives out here rather
+# than in `stream_data` so that restarts don't re-queue snapshots we already have.
+states: DefaultDict[str, StreamState] = defaultdict(StreamState)
+
+# Output directories that already exist, keyed by day (YYYYMMDD)
+outdirs: Dict[str, Path] = {}
+
+
+def trial_over() -> bool:
+    """Return whether the trial is over for today; checks the clock once a minute."""
 
-    def __post_init__(self):
-        """Replace cooldown of zero"""
+    global next_end_check, is_trial_over
 
-        if self.cooldown == 0:
-            self.cooldown = 15
+    now = time.time()
+    if now >= next_end_check:
+        is_trial_over = time.localtime(now).tm_hour >= END_HOUR
+        next_end_check = now + 60
 
+    return is_trial_over
 
-def write_to_file(data: Dict[Any, Any], stream_name: str, last_updated: int) -> None:
-    """Write response data to an output file.
+
+def output_dir(day: str) -> Path:
+    """Return the output directory for the given day, creating it on first use."""
+
+    outdir = outdirs.get(day)
+    if outdir is None:
+        outdir = Path("data") / day
+        outdir.mkdir(parents=True, exist_ok=True)
+        outdirs[day] = outdir
+
+    return outdir
+
+
+def write_to_file(records: List[Dict[Any, Any]], stream_name: str) -> None:
+    """Append a batch of response data to the stream's daily output file.
 
     Parameters
     --------
-    data: Dict[Any, Any]
-        Dictionary of response data. This will be written as to a JSON file without
-        concern for its contents.
+    records: List[Dict[Any, Any]]
+        Dictionaries of response data. Each is written as one line of compact JSON
+        without concern for its contents.
 
     stream_name: str
-        The name of the stream from which the data came
+        The name of the stream from which the data came; this is the filename.
+
+    """
+
+    outdir = output_dir(time.strftime("%Y%m%d"))
+
+    # Compact, gzipped JSON Lines in a single write; these are archives for machines,
+    # not people. Appending makes each batch its own gzip member, which readers
+    # concatenate. Level 1 gets most of the ratio on the repetitive GBFS keys.
+    payload = b"".join(orjson.dumps(record) + b"\n" for record in records)
+    member = gzip.compress(payload, compresslevel=1)
+
+    # Normally the whole member goes out in one O_APPEND write. If a write fails partway
+    # (e.g., a full disk), cut the file back to where it was: half a member would break
+    # everything appended after it, including this batch when the flusher retries it.
+    outfile = outdir.joinpath(f"{stream_name}.jsonl.gz")
+    fd = os.open(outfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        try:
+            view = memoryview(member)
+            while view:  # regular files only write partially in odd cases
+                view = view[os.write(fd, view) :]
+        except BaseException:
+            os.ftruncate(fd, size)
+            raise
+    finally:
+        os.close(fd)
+
+    logger.debug("Wrote {} snapshots from {} to file", len(records), stream_name)
+
+
+async def flush_pending() -> None:
+    """Write out every stream's pending snapshots, one file append per stream."""
 
-    last_updated: int
-        The Unix time at which the data was generated. We say int, but this is really what
-        the filename will be; it could be anything.
+    loop = asyncio.get_running_loop()
+    for stream_name in list(pending):
+        records = pending.pop(stream_name)
+        try:
+            # Disk I/O goes to the default thread pool so other streams keep polling
+            await loop.run_in_executor(None, write_to_file, records, stream_name)
+        except Exception as e:
+            # Put the batch back (ahead of anything queued meanwhile) for the next flush
+            pending[stream_name][:0] = records
+            logger.error(f"Failed to write {stream_name} snapshots, will retry: {e}")
+
+
+async def flusher(done: asyncio.Event, interval: int = 60) -> None:
+    """Flush pending snapshots to disk every so often, and once more when we're done.
+
+    Parameters
+    --------
+    done: asyncio.Event
+        Set when the streams have stopped; triggers the final flush.
 
+    interval: int
+        Seconds between flushes.
     """
 
-    outdir = Path("data") / datetime.now().strftime("%Y%m%d") / stream_name
-    if not outdir.exists():
-        outdir.mkdir(parents=True)
+    while not done.is_set():
+        try:
+            await asyncio.wait_for(done.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        await flush_pending()
 
-    with open(outdir.joinpath(f"{last_updated}.json"), "w") as f:
-        json.dump(data, f, indent=4)
-        logger.debug(f"Wrote data from {stream_name} at {last_updated} to file")
+    # Always flush once more, even if we were already done when we started (e.g., the
+    # first flush of a restart that has nothing left to poll for)
+    await flush_pending()
 
 
-async def stream_data(name: str, url: str, cooldown: int) -> Any:
-    """Asyncrhonously data from some endpoint at a regular interval
+async def poll_stream(
+    session: aiohttp.ClientSession, params: StreamParams, state: StreamState
+) -> float:
+    """Poll one stream once, queue any new data, and say when to poll it next.
 
-    Hit the provided URL with a GET request at an interval specified by the cooldown. If
-    new data is available, yield it back to the caller. In the meantime, sleep and cede
-    control back to the main event loop.
+    Hit the stream's URL with a (conditional) GET request. If new data is available,
+    queue it for the flusher and schedule the next poll for just before the stream is
+    due to refresh again; otherwise, try again shortly.
 
     Parameters
     --------
-    name: str
-        The (preferably short) name of the stream that we're getting data from
+    session: aiohttp.ClientSession
+        Shared HTTP session; reusing it keeps connections alive between polls.
 
-    url: str
-        URL to get data from; must be accessible via GET request.
+    params: StreamParams
+        Which stream to poll and how often it refreshes.
+
+    state: StreamState
+        What we know about the stream from earlier polls; updated in place.
 
-    cooldown: int
-        The interval at which the data is refreshed.
+    Returns
+    --------
+    float
+        The `time.monotonic()` time at which the stream should next be polled.
     """
 
-    last_updated = 0  # after request is made, will be unixtime
-    while datetime.now().hour < 22:  # trial period ends at 10 PM nightly
-        data = requests.get(url).json()
+    name = params.name
+    polled_at = time.monotonic()
+    async with session.get(params.url, headers=state.validators) as resp:
+        if resp.status == 304:  # Not Modified; nothing to download or parse
+            logger.debug("No data available yet for {}", name)
+            return time.monotonic() + 0.5
+
+        # An error page isn't the feed: don't parse it or remember its validators
+        resp.raise_for_status()
+
+        state.validators = {}
+        if "ETag" in resp.headers:
+            state.validators["If-None-Match"] = resp.headers["ETag"]
+        if "Last-Modified" in resp.headers:
+            state.validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+
+        payload = await resp.read()
+
+    # Most polls turn up nothing new, so peek at the timestamp near the top of the
+    # payload and only parse the whole thing if it's moved on. Only look before the
+    # "data" key: GBFS puts nothing else nested at the top level, so a match there is
+    # the top-level timestamp and not one belonging to a bike.
+    peek_end = payload.find(b'"data"', 0, 4096)
+    match = LAST_UPDATED_PATTERN.search(payload, 0, 4096 if peek_end < 0 else peek_end)
+    if match is not None and float(match.group(1)) <= state.last_updated:
+        logger.debug("No data available yet for {}", name)
+        return time.monotonic() + 0.5
+
+    data = orjson.loads(payload)
+
+    updated = data.get(LAST_UPDATED)
+    if updated is None:  # edge case for VeoRide not following the spec
+        updated = data.get(LAST_UPDATED_CAMEL)
+
+    if updated is None or updated <= state.last_updated:
+        logger.debug("No data available yet for {}", name)
+        return time.monotonic() + 0.5
+
+    state.last_updated = data[LAST_UPDATED] = updated
+    logger.info(f"New data available for {name}: {updated}")
+
+    # Some providers bump last_updated without the bikes actually changing
+    content_hash = hashlib.blake2b(
+        orjson.dumps(data.get("data", data)), digest_size=16
+    ).digest()
+    if content_hash == state.last_hash:
+        logger.debug("Content unchanged for {}, skipping", name)
+    else:
+        state.last_hash = content_hash
+        pending[name].append(data)
+
+    # Relative to when we polled, so fetch and hashing time doesn't push every later
+    # poll back
+    logger.debug("Sleeping {} for {}", name, params.cooldown)
+    return polled_at + params.cooldown - 1
+
+
+async def stream_data(
+    session: aiohttp.ClientSession, stream_params: Sequence[StreamParams]
+) -> bool:
+    """Poll every stream from one coroutine until the trial is over for the day
+
+    Streams wait in a heap ordered by when they're next due. Due streams get a fetch
+    task each; in between, we wait for either the next deadline or a fetch to finish,
+    whichever comes first. A stream is only pushed back onto the heap once its fetch is
+    done, so each has at most one request in flight. If any fetch fails, the others are
+    cancelled and the exception propagates up to the restart loop in __main__.
 
-        if "lastUpdated" in data.keys():  # edge case for VeoRide not following the spec
-            data["last_updated"] = data["lastUpdated"]
+    Parameters
+    --------
+    session: aiohttp.ClientSession
+        Shared HTTP session; reusing it keeps connections alive between polls.
 
-        if data["last_updated"] > last_updated:
-            last_updated = data["last_updated"]
-            logger.info(f"New data available for {name}: {last_updated}")
+    stream_params: Sequence[StreamParams]
+        The streams to poll.
+    """
 
-            write_to_file(data, name, last_updated)
+    # (due time, index, params, state); the index breaks ties between equal due times
+    due: List[Tuple[float, int, StreamParams, StreamState]] = [
+        (0.0, i, params, states[params.name]) for i, params in enumerate(stream_params)
+    ]
+    inflight: Dict["asyncio.Future[float]", Tuple[int, StreamParams, StreamState]] = {}
+
+    try:
+        while not trial_over():
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                _, i, params, state = heapq.heappop(due)
+                task = asyncio.ensure_future(poll_stream(session, params, state))
+                inflight[task] = (i, params, state)
+
+            timeout = max(0.0, due[0][0] - now) if due else None
+            if not inflight:
+                await asyncio.sleep(timeout)
+                continue
+
+            finished, _ = await asyncio.wait(
+                inflight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in finished:
+                i, params, state = inflight.pop(task)
+                heapq.heappush(due, (task.result(), i, params, state))
+
+    finally:
+        for task in inflight:
+            task.cancel()
+        await asyncio.gather(*inflight, return_exceptions=True)
 
-            logger.debug(f"Sleeping {name} for {cooldown}")
-            await asyncio.sleep(cooldown - 1)
+    return True  # when done
 
-        else:
-            logger.debug(f"No data available yet for {name}")
-            await asyncio.sleep(0.5)
 
-    return True  # when done
+# Every stream we collect; built once, at import
+STREAMS: Tuple[StreamParams, ...] = (
+    StreamParams(
+        name="bird",
+        url="https://mds.bird.co/gbfs/chicago/free_bike_status.json",
+        cooldown=60,
+    ),
+    StreamParams(
+        name="bolt",
+        url="https://www.bolt.miami/bolt2/chi/gbfs/en/free_bike_status.json",
+        cooldown=60,
+    ),
+    StreamParams(
+        name="gruv",
+        url="https://portal.clevrmobility.com/api/gbfs/chicago/en/free_bike_status/?format=json",
+        cooldown=60,
+    ),
+    StreamParams(
+        name="jump",
+        url="https://gbfs.uber.com/v1/chicago/free_bike_status.json",
+        cooldown=60,
+    ),
+    StreamParams(
+        name="lime",
+        url="https://data.lime.bike/api/partners/v1/gbfs/chicago/free_bike_status",
+    ),
+    StreamParams(
+        name="lyft",
+        url="https://s3.amazonaws.com/lyft-lastmile-production-iad/lbs/chi/free_bike_status.json",
+        cooldown=300,
+    ),
+    StreamParams(
+        name="sherpa",
+        url="https://mds.bird.co/gbfs/platform-partner/sherpa/chicago/free_bike_status.json",
+        cooldown=60,
+    ),
+    StreamParams(
+        name="spin",
+        url="https://web.spin.pm/api/gbfs/v1/chicago/free_bike_status",
+    ),
+    StreamParams(
+        name="wheels",
+        url="https://chicago-gbfs.getwheelsapp.com/free_bike_status.json",
+        cooldown=30,
+    ),
+    StreamParams(
+        name="veoride",
+        url="https://share.veoride.com/api/share/gbfs/free_bike_status?area_name=Chicago",
+    ),
+)
 
 
 @logger.catch
 async def all_streams():
-    stream_params: List[StreamParams] = [
-        StreamParams(
-            name="bird",
-            url="https://mds.bird.co/gbfs/chicago/free_bike_status.json",
-            cooldown=60,
-        ),
-        StreamParams(
-            name="bolt",
-            url="https://www.bolt.miami/bolt2/chi/gbfs/en/free_bike_status.json",
-            cooldown=60,
-        ),
-        StreamParams(
-            name="gruv",
-            url="https://portal.clevrmobility.com/api/gbfs/chicago/en/free_bike_status/?format=json",
-            cooldown=60,
-        ),
-        StreamParams(
-            name="jump",
-            url="https://gbfs.uber.com/v1/chicago/free_bike_status.json",
-            cooldown=60,
-        ),
-        StreamParams(
-            name="lime",
-            url="https://data.lime.bike/api/partners/v1/gbfs/chicago/free_bike_status",
-            cooldown=0,
-        ),
-        StreamParams(
-            name="lyft",
-            url="https://s3.amazonaws.com/lyft-lastmile-production-iad/lbs/chi/free_bike_status.json",
-            cooldown=300,
-        ),
-        StreamParams(
-            name="sherpa",
-            url="https://mds.bird.co/gbfs/platform-partner/sherpa/chicago/free_bike_status.json",
-            cooldown=60,
-        ),
-        StreamParams(
-            name="spin",
-            url="https://web.spin.pm/api/gbfs/v1/chicago/free_bike_status",
-            cooldown=0,
-        ),
-        StreamParams(
-            name="wheels",
-            url="https://chicago-gbfs.getwheelsapp.com/free_bike_status.json",
-            cooldown=30,
-        ),
-        StreamParams(
-            name="veoride",
-            url="https://share.veoride.com/api/share/gbfs/free_bike_status?area_name=Chicago",
-            cooldown=0,
-        ),
-    ]
-
-    # The individual coroutines will return when they are all done (i.e., at 10PM)
-    return await asyncio.gather(
-        *[
-            stream_data(params.name, params.url, params.cooldown)
-            for params in stream_params
-        ]
-    )
+    # One pooled connector for every stream; DNS for the handful of hosts is cached
+    connector = aiohttp.TCPConnector(limit=20, ttl_dns_cache=600)
+    timeout = aiohttp.ClientTimeout(total=10)
+    done = asyncio.Event()
+    flush_task = asyncio.ensure_future(flusher(done))
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            # Everything allocated so far lives all day; keep the collector from
+            # rescanning it, and let parsed responses pile up a while before collecting
+            gc.collect()
+            gc.freeze()
+            gc.set_threshold(100_000, 50, 50)
+
+            # This will return when the streams are all done for the day (i.e., at 10PM)
+            return await stream_data(session, STREAMS)
+    finally:
+        # Don't lose buffered snapshots, whether we're done for the day or restarting
+        done.set()
+        await flush_task
 
 
 if __name__ == "__main__":
     # Exception handling is overrated
-    logger.add("logs/{time:YYYYMMDD}.log")
+    # DEBUG fires on every poll of every stream; loguru skips formatting the debug calls
+    # (which pass arguments instead of f-strings) when no sink wants them
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    logger.add("logs/{time:YYYYMMDD}.log", level="INFO")
+
+    try:  # faster event loop if we have it; asyncio's default works fine otherwise
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not installed, using the default event loop")
+
     while True:
         try:
             is_done = asyncio.run(all_streams())
-            if all(is_done):
+            if is_done:
                 logger.info("All done for the day!")
                 break
+            logger.error(f"Restarting ...")
         except Exception as e:
             logger.error(f"{e}")
             logger.error(f"Restarting ...")